@@ -20,7 +20,7 @@ except ImportError:
 
 import txtfile_func
 
-__verison__ = (0, 1, 1, 1)
+__verison__ = (0, 1, 2, 1)
 
 DEBUG_MODE = True
 
@@ -255,73 +255,66 @@ def main(*argv):
             info(u'Set <modarin256> skin in file <%s>' % ini_filename)
 
         menu_filename = os.path.join(home_path, '.config', 'mc', 'menu')
-        if not os.path.exists(menu_filename):
-            src_menu_filename = os.path.join('etc', 'mc', 'mc.menu')
-            if os.path.exists(src_menu_filename):
-                shutil.copyfile(src_menu_filename, menu_filename)
-                os.chmod(menu_filename, stat.S_IWUSR | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        with txtfile_func.lockTextFile(menu_filename):
+            if not os.path.exists(menu_filename):
+                src_menu_filename = os.path.join('etc', 'mc', 'mc.menu')
+                if os.path.exists(src_menu_filename):
+                    shutil.copyfile(src_menu_filename, menu_filename)
+                    os.chmod(menu_filename, stat.S_IWUSR | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
 
         # neofetch / System information
-        if not txtfile_func.isInTextFile(menu_filename, NEOFETCH_MENUITEM):
-            txtfile_func.appendTextFile(menu_filename, NEOFETCH_MENUITEM)
+        if txtfile_func.appendTextFileIfNotExists(menu_filename, NEOFETCH_MENUITEM):
             info(u'Add <neofetch> system information in file <%s>' % menu_filename)
 
         # htop / Task monitor
-        if not txtfile_func.isInTextFile(menu_filename, HTOP_MENUITEM):
-            txtfile_func.appendTextFile(menu_filename, HTOP_MENUITEM)
+        if txtfile_func.appendTextFileIfNotExists(menu_filename, HTOP_MENUITEM):
             info(u'Add <htop> task monitor in file <%s>' % menu_filename)
 
         # btop / Task monitor
-        if not txtfile_func.isInTextFile(menu_filename, BTOP_MENUITEM):
-            txtfile_func.appendTextFile(menu_filename, BTOP_MENUITEM)
+        if txtfile_func.appendTextFileIfNotExists(menu_filename, BTOP_MENUITEM):
             info(u'Add <btop> task monitor in file <%s>' % menu_filename)
 
         # mtr / Traceroute
-        if not txtfile_func.isInTextFile(menu_filename, MTR_MENUITEM):
-            txtfile_func.appendTextFile(menu_filename, MTR_MENUITEM)
+        if txtfile_func.appendTextFileIfNotExists(menu_filename, MTR_MENUITEM):
             info(u'Add <mtr> traceroute tool in file <%s>' % menu_filename)
 
         # lazygit / Git manager
-        if not txtfile_func.isInTextFile(menu_filename, GIT_MENUITEM):
-            txtfile_func.appendTextFile(menu_filename, GIT_MENUITEM)
+        if txtfile_func.appendTextFileIfNotExists(menu_filename, GIT_MENUITEM):
             info(u'Add <git> Git manager in file <%s>' % menu_filename)
 
         # python / Python interpreter
-        if not txtfile_func.isInTextFile(menu_filename, PY_MENUITEM):
-            txtfile_func.appendTextFile(menu_filename, PY_MENUITEM)
+        if txtfile_func.appendTextFileIfNotExists(menu_filename, PY_MENUITEM):
             info(u'Add <python> Python interpreter in file <%s>' % menu_filename)
 
         # ddgr / Internet searching
-        if not txtfile_func.isInTextFile(menu_filename, DDGR_MENUITEM):
-            txtfile_func.appendTextFile(menu_filename, DDGR_MENUITEM)
+        if txtfile_func.appendTextFileIfNotExists(menu_filename, DDGR_MENUITEM):
             info(u'Add <ddgr> Internet searching in file <%s>' % menu_filename)
 
         # lynx / Internet browser
-        if not txtfile_func.isInTextFile(menu_filename, LYNX_MENUITEM):
-            txtfile_func.appendTextFile(menu_filename, LYNX_MENUITEM)
+        if txtfile_func.appendTextFileIfNotExists(menu_filename, LYNX_MENUITEM):
             info(u'Add <lynx> Internet browser in file <%s>' % menu_filename)
 
         # NG / Norton Guide Viewer
-        if not txtfile_func.isInTextFile(menu_filename, NG_MENUITEM):
-            txtfile_func.appendTextFile(menu_filename, NG_MENUITEM)
+        if txtfile_func.appendTextFileIfNotExists(menu_filename, NG_MENUITEM):
             info(u'Add <NG> Norton Guide Viewer in file <%s>' % menu_filename)
 
         ext_filename = os.path.join(home_path, '.config', 'mc', 'mc.ext.ini')
-        if not os.path.exists(ext_filename):
-            src_ext_filename = os.path.join(os.path.sep, 'etc', 'mc', 'mc.ext.ini')
-            if os.path.exists(src_ext_filename):
-                shutil.copyfile(src_ext_filename, ext_filename)
-                os.chmod(ext_filename, stat.S_IWUSR | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
-                info(u'Copy INI file <%s> -> <%s>' % (src_ext_filename, ext_filename))
-            else:
-                warning(u'Not found <%s> INI file' % src_ext_filename)
+        with txtfile_func.lockTextFile(ext_filename):
+            if not os.path.exists(ext_filename):
+                src_ext_filename = os.path.join(os.path.sep, 'etc', 'mc', 'mc.ext.ini')
+                if os.path.exists(src_ext_filename):
+                    shutil.copyfile(src_ext_filename, ext_filename)
+                    os.chmod(ext_filename, stat.S_IWUSR | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    info(u'Copy INI file <%s> -> <%s>' % (src_ext_filename, ext_filename))
+                else:
+                    warning(u'Not found <%s> INI file' % src_ext_filename)
 
 
         # Log files
-        if not txtfile_func.isInTextFile(ext_filename, LOG_EXT_VIEWER):
-            txtfile_func.replaceTextFile(ext_filename,
-                                         src_text=MISC_EXT_SIGNATURE,
-                                         dst_text=MISC_EXT_SIGNATURE+os.linesep+LOG_EXT_VIEWER)
+        if txtfile_func.replaceTextFileIfNotExists(ext_filename,
+                                                   find_text=LOG_EXT_VIEWER,
+                                                   src_text=MISC_EXT_SIGNATURE,
+                                                   dst_text=MISC_EXT_SIGNATURE+os.linesep+LOG_EXT_VIEWER):
             info(u'Add <log> files viewer in file <%s>' % ext_filename)
 
         # # PDF files
@@ -406,6 +399,13 @@ def main(*argv):
         #                                  dst_text='scaler=normal2x forced')
         #     info(u'Set <scaler> X 2 for DosBox in file <%s>' % dosbox_conf_filename)
 
+        lock_stats = txtfile_func.getLockStats()
+        debug(u'File locks: acquired %d, contended %d, timeouts %d, fallback %d, unlocked %d' % (lock_stats['acquired'],
+                                                                                              lock_stats['contended'],
+                                                                                              lock_stats['timeouts'],
+                                                                                              lock_stats['fallback'],
+                                                                                              lock_stats['unlocked']))
+        debug(u'File lock wait: total %.3f s, max %.3f s' % (lock_stats['wait_total'], lock_stats['wait_max']))
         info(u'... STOP Config Midnight Commander')
     except:
         fatal(u'Programm  error:')
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Text file lock tests.
+"""
+
+import os
+import os.path
+import time
+import socket
+import shutil
+import tempfile
+import multiprocessing
+
+import pytest
+
+import txtfile_func
+
+NOBODY_ID = 65534
+
+MENU_ITEMS = ['\nITEM %d\n        command %d\n' % (i, i) for i in range(10)]
+
+
+def _addMenuItems(txt_filename, use_fcntl=True):
+    """
+    Add all menu items in text file. Runs in a child process.
+    """
+    if not use_fcntl:
+        txtfile_func.fcntl = None
+    for menu_item in MENU_ITEMS:
+        txtfile_func.appendTextFileIfNotExists(txt_filename, menu_item)
+
+
+def _holdLock(txt_filename, use_fcntl, hold_time):
+    """
+    Hold text file lock. Runs in a child process.
+    """
+    if not use_fcntl:
+        txtfile_func.fcntl = None
+    with txtfile_func.lockTextFile(txt_filename):
+        time.sleep(hold_time)
+
+
+def _runProcesses(target, args_list):
+    processes = [multiprocessing.Process(target=target, args=args) for args in args_list]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+
+@pytest.mark.parametrize('use_fcntl', [True, False])
+def test_concurrent_append_no_duplicates(tmp_path, use_fcntl):
+    txt_filename = str(tmp_path / 'menu')
+    _runProcesses(_addMenuItems, [(txt_filename, use_fcntl)] * 8)
+
+    txt = txtfile_func.loadTextFile(txt_filename)
+    for menu_item in MENU_ITEMS:
+        assert txt.count(menu_item.strip()) == 1
+    assert not os.path.exists(txt_filename + txtfile_func.FALLBACK_LOCK_FILE_EXT)
+
+
+@pytest.mark.parametrize('holder_fcntl,waiter_fcntl', [(True, False), (False, True)])
+def test_fcntl_and_fallback_exclude_each_other(tmp_path, monkeypatch, holder_fcntl, waiter_fcntl):
+    txt_filename = str(tmp_path / 'menu')
+    holder = multiprocessing.Process(target=_holdLock, args=(txt_filename, holder_fcntl, 2.0))
+    holder.start()
+    try:
+        fallback_lock_filename = txt_filename + txtfile_func.FALLBACK_LOCK_FILE_EXT
+        while not os.path.exists(fallback_lock_filename):
+            time.sleep(0.01)
+
+        if not waiter_fcntl:
+            monkeypatch.setattr(txtfile_func, 'fcntl', None)
+        with pytest.raises(txtfile_func.LockTimeoutError):
+            with txtfile_func.lockTextFile(txt_filename, timeout=0.3):
+                pass
+    finally:
+        holder.join()
+
+
+def test_fallback_breaks_dead_process_lock(tmp_path, monkeypatch):
+    monkeypatch.setattr(txtfile_func, 'fcntl', None)
+    txt_filename = str(tmp_path / 'menu')
+    fallback_lock_filename = txt_filename + txtfile_func.FALLBACK_LOCK_FILE_EXT
+
+    process = multiprocessing.Process(target=time.sleep, args=(0,))
+    process.start()
+    process.join()
+    with open(fallback_lock_filename, 'wt') as file_obj:
+        file_obj.write('%s:%d:dead' % (socket.gethostname(), process.pid))
+
+    with txtfile_func.lockTextFile(txt_filename, timeout=1.0):
+        assert txtfile_func._readLockFile(fallback_lock_filename) != '%s:%d:dead' % (socket.gethostname(),
+                                                                                      process.pid)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_fallback_breaks_old_lock_of_other_host(tmp_path, monkeypatch):
+    monkeypatch.setattr(txtfile_func, 'fcntl', None)
+    txt_filename = str(tmp_path / 'menu')
+    fallback_lock_filename = txt_filename + txtfile_func.FALLBACK_LOCK_FILE_EXT
+
+    with open(fallback_lock_filename, 'wt') as file_obj:
+        file_obj.write('other-host:1:old')
+    old_time = time.time() - txtfile_func.LOCK_STALE_TIMEOUT - 1
+    os.utime(fallback_lock_filename, (old_time, old_time))
+
+    with txtfile_func.lockTextFile(txt_filename, timeout=1.0):
+        pass
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_fallback_keeps_live_lock_of_other_host(tmp_path, monkeypatch):
+    monkeypatch.setattr(txtfile_func, 'fcntl', None)
+    txt_filename = str(tmp_path / 'menu')
+    fallback_lock_filename = txt_filename + txtfile_func.FALLBACK_LOCK_FILE_EXT
+
+    with open(fallback_lock_filename, 'wt') as file_obj:
+        file_obj.write('other-host:1:live')
+
+    with pytest.raises(txtfile_func.LockTimeoutError):
+        with txtfile_func.lockTextFile(txt_filename, timeout=0.3):
+            pass
+    assert txtfile_func._readLockFile(fallback_lock_filename) == 'other-host:1:live'
+
+
+def test_break_does_not_remove_replaced_lock(tmp_path):
+    fallback_lock_filename = str(tmp_path / 'menu.lck')
+    with open(fallback_lock_filename, 'wt') as file_obj:
+        file_obj.write('other-host:1:live')
+
+    # The stale lock file has already been replaced by a live one
+    assert not txtfile_func._breakStaleLockFile(fallback_lock_filename, 'other-host:1:stale')
+    assert txtfile_func._readLockFile(fallback_lock_filename) == 'other-host:1:live'
+    assert os.listdir(str(tmp_path)) == ['menu.lck']
+
+
+def _appendAsNobody(txt_filename):
+    """
+    Add menu items as <nobody> user. Runs in a child process.
+    """
+    os.setgid(NOBODY_ID)
+    os.setuid(NOBODY_ID)
+    _addMenuItems(txt_filename)
+
+
+def test_lock_files_get_text_file_permissions(tmp_path):
+    txt_filename = str(tmp_path / 'menu')
+    with open(txt_filename, 'wt') as file_obj:
+        file_obj.write('menu')
+    os.chmod(txt_filename, 0o666)
+
+    with txtfile_func.lockTextFile(txt_filename):
+        if txtfile_func.fcntl is not None:
+            assert os.stat(txt_filename + txtfile_func.LOCK_FILE_EXT).st_mode & 0o777 == 0o666
+        assert os.stat(txt_filename + txtfile_func.FALLBACK_LOCK_FILE_EXT).st_mode & 0o777 == 0o666
+
+
+def test_read_only_location_is_read_without_lock(tmp_path, monkeypatch):
+    txt_filename = str(tmp_path / 'passwd')
+    txtfile_func.saveTextFile(txt_filename, 'root:x:0:0')
+
+    os_open = os.open
+
+    def deniedOpen(filename, *args, **kwargs):
+        if filename.endswith((txtfile_func.LOCK_FILE_EXT, txtfile_func.FALLBACK_LOCK_FILE_EXT)):
+            raise PermissionError(13, 'Permission denied', filename)
+        return os_open(filename, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'open', deniedOpen)
+    txtfile_func.resetLockStats()
+    assert txtfile_func.isInTextFile(txt_filename, 'root')
+    assert txtfile_func.loadTextFile(txt_filename) == 'root:x:0:0'
+    assert txtfile_func.getLockStats()['unlocked'] == 2
+
+
+@pytest.mark.skipif(not hasattr(os, 'geteuid') or os.geteuid() != 0, reason='Requires root')
+def test_lock_file_of_root_does_not_block_user():
+    # pytest tmp_path is not available for other users
+    shared_path = tempfile.mkdtemp()
+    try:
+        os.chmod(shared_path, 0o777)
+        txt_filename = os.path.join(shared_path, 'menu')
+        with open(txt_filename, 'wt') as file_obj:
+            file_obj.write('menu')
+        os.chmod(txt_filename, 0o666)
+
+        txtfile_func.appendTextFileIfNotExists(txt_filename, MENU_ITEMS[0])
+        _runProcesses(_appendAsNobody, [(txt_filename,)])
+
+        txt = txtfile_func.loadTextFile(txt_filename)
+        for menu_item in MENU_ITEMS:
+            assert txt.count(menu_item.strip()) == 1
+    finally:
+        shutil.rmtree(shared_path)
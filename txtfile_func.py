@@ -7,10 +7,430 @@ Text file functions.
 
 import os
 import os.path
+import errno
+import stat
+import time
+import uuid
+import socket
+import threading
+import contextlib
 import termcolor
 import jinja2
 
-__version__ = (0, 0, 3, 2)
+try:
+    import fcntl
+except ImportError:
+    # Not POSIX (Windows). Only lock files are available
+    fcntl = None
+
+__version__ = (0, 0, 4, 2)
+
+# Lock wait timeout in seconds
+LOCK_TIMEOUT = 30.0
+# Lock polling interval in seconds
+LOCK_POLL_INTERVAL = 0.05
+# Lock file age in seconds after which a lock file of another host is considered stale.
+# Must be less than LOCK_TIMEOUT, otherwise waiters time out before breaking it
+LOCK_STALE_TIMEOUT = 20.0
+
+# fcntl lock file extension
+LOCK_FILE_EXT = '.lock'
+# Exclusive (O_EXCL) lock file extension
+FALLBACK_LOCK_FILE_EXT = '.lck'
+
+# fcntl error codes for which we switch to lock files only (NFS without lockd and etc.)
+_FCNTL_UNSUPPORTED_ERRNOS = (errno.ENOLCK, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL)
+# Error codes for which the lock file can not be created (read only locations)
+_LOCK_DENIED_ERRNOS = (errno.EACCES, errno.EPERM, errno.EROFS)
+
+# Lock wait metrics
+LOCK_STATS = dict(acquired=0, contended=0, timeouts=0, fallback=0, unlocked=0,
+                  wait_total=0.0, wait_max=0.0)
+
+_LOCK_GUARD = threading.Lock()
+# Text filename -> threading.RLock. Serialize threads of this process
+_THREAD_LOCKS = dict()
+# Text filename -> Nested lock depth
+_HELD_LOCKS = dict()
+
+
+class LockTimeoutError(Exception):
+    """
+    Text file lock wait timeout exceeded.
+    """
+    pass
+
+
+def getLockStats():
+    """
+    Get text file lock wait metrics.
+
+    :return: Dictionary:
+        acquired - Number of acquired locks.
+        contended - Number of locks that had to wait.
+        timeouts - Number of lock wait timeouts.
+        fallback - Number of locks acquired without fcntl.
+        unlocked - Number of accesses without lock (read only locations).
+        wait_total - Total lock wait time in seconds.
+        wait_max - Maximum lock wait time in seconds.
+    """
+    with _LOCK_GUARD:
+        return dict(LOCK_STATS)
+
+
+def resetLockStats():
+    """
+    Reset text file lock wait metrics.
+    """
+    with _LOCK_GUARD:
+        LOCK_STATS.update(acquired=0, contended=0, timeouts=0, fallback=0, unlocked=0,
+                          wait_total=0.0, wait_max=0.0)
+
+
+def _registerLockWait(wait_time, is_contended=False, is_timeout=False, is_fallback=False,
+                      is_unlocked=False):
+    """
+    Register lock wait in metrics.
+
+    :param wait_time: Lock wait time in seconds.
+    :param is_contended: Did you have to wait for the lock?
+    :param is_timeout: Lock wait timeout exceeded?
+    :param is_fallback: Lock acquired without fcntl?
+    :param is_unlocked: Lock file can not be created?
+    """
+    with _LOCK_GUARD:
+        if is_timeout:
+            LOCK_STATS['timeouts'] += 1
+        elif is_unlocked:
+            LOCK_STATS['unlocked'] += 1
+        else:
+            LOCK_STATS['acquired'] += 1
+        if is_contended:
+            LOCK_STATS['contended'] += 1
+        if is_fallback:
+            LOCK_STATS['fallback'] += 1
+        LOCK_STATS['wait_total'] += wait_time
+        LOCK_STATS['wait_max'] = max(LOCK_STATS['wait_max'], wait_time)
+
+
+def _createLockFile(lock_filename, txt_filename, flags):
+    """
+    Open lock file with the permissions and owner of the text file.
+    So lock file created by root does not block the user.
+
+    :param lock_filename: Lock filename.
+    :param txt_filename: Locked text filename.
+    :param flags: os.open flags. O_CREAT is added.
+    :return: File descriptor.
+    """
+    try:
+        fd = os.open(lock_filename, flags | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        if flags & os.O_EXCL:
+            raise
+        return os.open(lock_filename, flags)
+
+    try:
+        if os.path.exists(txt_filename):
+            src_stat = os.stat(txt_filename)
+            # Permissions are set after creation because os.open is limited by umask
+            os.chmod(lock_filename, stat.S_IMODE(src_stat.st_mode) & 0o666)
+        else:
+            src_stat = os.stat(os.path.dirname(txt_filename))
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            os.chown(lock_filename, src_stat.st_uid, src_stat.st_gid)
+    except OSError:
+        print(termcolor.colored(u'Error set permissions of lock file <%s>' % lock_filename, 'yellow'))
+    return fd
+
+
+def _acquireFcntlLock(lock_filename, txt_filename, deadline):
+    """
+    Acquire fcntl lock on lock file.
+
+    :param lock_filename: Lock filename.
+    :param txt_filename: Locked text filename.
+    :param deadline: time.monotonic() lock wait deadline.
+    :return: Tuple (Lock file descriptor, did you have to wait?)
+        or (None, False) if fcntl locks are not supported by file system
+        or lock file can not be opened.
+    """
+    is_created = not os.path.exists(lock_filename)
+    try:
+        fd = _createLockFile(lock_filename, txt_filename, os.O_RDWR)
+    except OSError as exception:
+        if exception.errno in _LOCK_DENIED_ERRNOS:
+            return None, False
+        raise
+
+    is_contended = False
+    while True:
+        try:
+            # lockf (POSIX locks) unlike flock works on NFS through lockd
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd, is_contended
+        except OSError as exception:
+            if exception.errno in _FCNTL_UNSUPPORTED_ERRNOS:
+                os.close(fd)
+                if is_created:
+                    # Do not leave a useless lock file
+                    try:
+                        os.remove(lock_filename)
+                    except OSError:
+                        pass
+                return None, False
+            if exception.errno not in (errno.EACCES, errno.EAGAIN):
+                os.close(fd)
+                raise
+        is_contended = True
+        if time.monotonic() >= deadline:
+            os.close(fd)
+            raise LockTimeoutError(u'Lock file <%s> wait timeout' % lock_filename)
+        time.sleep(LOCK_POLL_INTERVAL)
+
+
+def _readLockFile(lock_filename):
+    """
+    Read lock file owner signature.
+
+    :param lock_filename: Lock filename.
+    :return: Signature <host>:<pid>:<token> or None if lock file not exists.
+    """
+    try:
+        with open(lock_filename, 'rt') as file_obj:
+            return file_obj.read()
+    except FileNotFoundError:
+        return None
+
+
+def _isStaleLockFile(lock_filename, signature):
+    """
+    Is the lock file holder dead?
+
+    :param lock_filename: Lock filename.
+    :param signature: Lock file signature <host>:<pid>:<token>.
+    :return: True/False.
+    """
+    try:
+        host, pid, _ = signature.rsplit(':', 2)
+        pid = int(pid)
+    except ValueError:
+        # The signature is not written yet or damaged
+        host, pid = None, None
+
+    if os.name == 'posix' and host == socket.gethostname() and pid:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # The process exists, but belongs to another user
+            pass
+
+    try:
+        return time.time() - os.path.getmtime(lock_filename) > LOCK_STALE_TIMEOUT
+    except FileNotFoundError:
+        return False
+
+
+def _breakStaleLockFile(lock_filename, signature):
+    """
+    Remove the stale lock file.
+    The lock file is renamed first. If it turns out that another waiter
+    has already replaced it with a live lock file, the live lock file is returned back.
+
+    :param lock_filename: Lock filename.
+    :param signature: Stale lock file signature.
+    :return: True - stale lock file removed, False - lock file is not stale.
+    """
+    stale_filename = '%s.%s' % (lock_filename, uuid.uuid4().hex)
+    try:
+        os.rename(lock_filename, stale_filename)
+    except FileNotFoundError:
+        return False
+
+    if _readLockFile(stale_filename) == signature:
+        os.remove(stale_filename)
+        print(termcolor.colored(u'Remove stale lock file <%s> (%s)' % (lock_filename, signature), 'yellow'))
+        return True
+
+    # This is a live lock file. Return it back
+    try:
+        os.link(stale_filename, lock_filename)
+    except FileExistsError:
+        print(termcolor.colored(u'Lock file <%s> is replaced while breaking' % lock_filename, 'red'))
+    os.remove(stale_filename)
+    return False
+
+
+def _acquireFallbackLock(lock_filename, txt_filename, deadline):
+    """
+    Acquire lock by exclusive creation of lock file.
+    The lock file contains the holder signature <host>:<pid>:<token>.
+
+    :param lock_filename: Lock filename.
+    :param txt_filename: Locked text filename.
+    :param deadline: time.monotonic() lock wait deadline.
+    :return: Tuple (Lock file signature, did you have to wait?)
+        or (None, False) if lock file can not be created.
+    """
+    signature = u'%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+    is_contended = False
+    while True:
+        try:
+            fd = _createLockFile(lock_filename, txt_filename, os.O_WRONLY | os.O_EXCL)
+            try:
+                os.write(fd, signature.encode())
+            finally:
+                os.close(fd)
+            return signature, is_contended
+        except FileExistsError:
+            pass
+        except OSError as exception:
+            if exception.errno in _LOCK_DENIED_ERRNOS:
+                return None, False
+            raise
+
+        # The lock file holder may have died
+        holder_signature = _readLockFile(lock_filename)
+        if holder_signature is None:
+            continue
+        if _isStaleLockFile(lock_filename, holder_signature):
+            _breakStaleLockFile(lock_filename, holder_signature)
+            continue
+
+        is_contended = True
+        if time.monotonic() >= deadline:
+            raise LockTimeoutError(u'Lock file <%s> wait timeout' % lock_filename)
+        time.sleep(LOCK_POLL_INTERVAL)
+
+
+def _releaseFallbackLock(lock_filename, signature):
+    """
+    Remove the lock file if it is still ours.
+
+    :param lock_filename: Lock filename.
+    :param signature: Lock file signature.
+    """
+    if _readLockFile(lock_filename) != signature:
+        print(termcolor.colored(u'Lock file <%s> was broken by another process' % lock_filename, 'red'))
+        return
+    try:
+        os.remove(lock_filename)
+    except OSError:
+        print(termcolor.colored(u'Error remove lock file <%s>' % lock_filename, 'red'))
+
+
+def _getThreadLock(txt_filename):
+    """
+    Get threading lock of text file.
+
+    :param txt_filename: Normalized text filename.
+    :return: threading.RLock object.
+    """
+    with _LOCK_GUARD:
+        if txt_filename not in _THREAD_LOCKS:
+            _THREAD_LOCKS[txt_filename] = threading.RLock()
+        return _THREAD_LOCKS[txt_filename]
+
+
+@contextlib.contextmanager
+def lockTextFile(txt_filename, timeout=None):
+    """
+    Exclusive advisory lock of text file.
+    Concurrent processes (also on other hosts through NFS) serialize
+    on the same file and run in parallel on different files.
+    fcntl lock is used on <txt_filename>.lock file, if it is available.
+    In any case <txt_filename>.lck lock file is created exclusively,
+    so processes with and without fcntl exclude each other.
+    Lock files get the permissions and owner of the text file.
+    If lock files can not be created (read only location),
+    then the text file is used without lock.
+    Lock is reentrant within one thread.
+
+    Usage:
+        with lockTextFile(txt_filename):
+            if not isInTextFile(txt_filename, txt):
+                appendTextFile(txt_filename, txt)
+
+    :param txt_filename: Text filename.
+    :param timeout: Lock wait timeout in seconds.
+        If not specified, then LOCK_TIMEOUT is used.
+    """
+    if timeout is None:
+        timeout = LOCK_TIMEOUT
+
+    txt_filename = os.path.abspath(os.path.normpath(txt_filename))
+    start_time = time.monotonic()
+    deadline = start_time + timeout
+
+    thread_lock = _getThreadLock(txt_filename)
+    if not thread_lock.acquire(timeout=max(timeout, 0)):
+        _registerLockWait(time.monotonic() - start_time, is_contended=True, is_timeout=True)
+        raise LockTimeoutError(u'Text file <%s> lock wait timeout' % txt_filename)
+
+    try:
+        if txt_filename in _HELD_LOCKS:
+            # Nested lock in the same thread
+            _HELD_LOCKS[txt_filename] += 1
+            try:
+                yield
+            finally:
+                _HELD_LOCKS[txt_filename] -= 1
+            return
+
+        is_contended = time.monotonic() - start_time >= LOCK_POLL_INTERVAL
+        if not os.path.isdir(os.path.dirname(txt_filename)):
+            # There is no directory. Nothing to lock and nothing to break
+            yield
+            return
+
+        lock_filename = txt_filename + LOCK_FILE_EXT
+        fallback_lock_filename = txt_filename + FALLBACK_LOCK_FILE_EXT
+        lock_fd = None
+        signature = None
+        try:
+            if fcntl is not None:
+                lock_fd, is_waited = _acquireFcntlLock(lock_filename, txt_filename, deadline)
+                is_contended = is_contended or is_waited
+            signature, is_waited = _acquireFallbackLock(fallback_lock_filename, txt_filename, deadline)
+            is_contended = is_contended or is_waited
+        except LockTimeoutError:
+            if lock_fd is not None:
+                os.close(lock_fd)
+            _registerLockWait(time.monotonic() - start_time, is_contended=True, is_timeout=True,
+                              is_fallback=lock_fd is None)
+            print(termcolor.colored(u'Text file <%s> lock wait timeout' % txt_filename, 'red'))
+            raise
+        except:
+            if lock_fd is not None:
+                os.close(lock_fd)
+            raise
+
+        if signature is None:
+            # Read only location. The text file can not be locked
+            if lock_fd is not None:
+                os.close(lock_fd)
+                lock_fd = None
+            _registerLockWait(time.monotonic() - start_time, is_unlocked=True)
+        else:
+            _registerLockWait(time.monotonic() - start_time, is_contended=is_contended,
+                              is_fallback=lock_fd is None)
+
+        _HELD_LOCKS[txt_filename] = 0
+        try:
+            yield
+        finally:
+            del _HELD_LOCKS[txt_filename]
+            if signature is not None:
+                _releaseFallbackLock(fallback_lock_filename, signature)
+            if lock_fd is not None:
+                # Closing the descriptor releases the lock.
+                # The lock file is not removed, otherwise waiting processes
+                # could lock the already deleted file
+                os.close(lock_fd)
+    finally:
+        thread_lock.release()
 
 
 def saveTextFile(txt_filename, txt='', rewrite=True):
@@ -27,17 +447,18 @@ def saveTextFile(txt_filename, txt='', rewrite=True):
 
     file_obj = None
     try:
-        if rewrite and os.path.exists(txt_filename):
-            os.remove(txt_filename)
-            print(termcolor.colored(u'Remove file <%s>' % txt_filename, 'green'))
-        if not rewrite and os.path.exists(txt_filename):
-            print(termcolor.colored(u'File <%s> not saved' % txt_filename, 'yellow'))
-            return False
+        with lockTextFile(txt_filename):
+            if rewrite and os.path.exists(txt_filename):
+                os.remove(txt_filename)
+                print(termcolor.colored(u'Remove file <%s>' % txt_filename, 'green'))
+            if not rewrite and os.path.exists(txt_filename):
+                print(termcolor.colored(u'File <%s> not saved' % txt_filename, 'yellow'))
+                return False
 
-        file_obj = open(txt_filename, 'wt')
-        file_obj.write(txt)
-        file_obj.close()
-        return True
+            file_obj = open(txt_filename, 'wt')
+            file_obj.write(txt)
+            file_obj.close()
+            return True
     except:
         if file_obj:
             file_obj.close()
@@ -59,9 +480,10 @@ def loadTextFile(txt_filename):
 
     file_obj = None
     try:
-        file_obj = open(txt_filename, 'rt')
-        txt = file_obj.read()
-        file_obj.close()
+        with lockTextFile(txt_filename):
+            file_obj = open(txt_filename, 'rt')
+            txt = file_obj.read()
+            file_obj.close()
     except:
         if file_obj:
             file_obj.close()
@@ -89,15 +511,16 @@ def appendTextFile(txt_filename, txt, cr=None):
 
     txt_filename = os.path.normpath(txt_filename)
 
-    if not os.path.exists(txt_filename):
-        cr = ''
-
     file_obj = None
     try:
-        file_obj = open(txt_filename, 'at')
-        file_obj.write(cr + txt)
-        file_obj.close()
-        return True
+        with lockTextFile(txt_filename):
+            if not os.path.exists(txt_filename):
+                cr = ''
+
+            file_obj = open(txt_filename, 'at')
+            file_obj.write(cr + txt)
+            file_obj.close()
+            return True
     except:
         if file_obj:
             file_obj.close()
@@ -122,30 +545,31 @@ def replaceTextFile(txt_filename, src_text, dst_text, auto_add=True, cr=None):
 
     txt_filename = os.path.normpath(txt_filename)
 
-    if os.path.exists(txt_filename):
-        file_obj = None
-        try:
-            file_obj = open(txt_filename, 'rt')
-            txt = file_obj.read()
-            file_obj.close()
-            txt = txt.replace(src_text, dst_text)
-            if auto_add and (dst_text not in txt):
-                txt += cr
-                txt += dst_text
-                print(termcolor.colored('Text file append <%s> in <%s>' % (dst_text, txt_filename), 'green'))
-            file_obj = None
-            file_obj = open(txt_filename, 'wt')
-            file_obj.write(txt)
-            file_obj.close()
+    with lockTextFile(txt_filename):
+        if os.path.exists(txt_filename):
             file_obj = None
-            return True
-        except:
-            if file_obj:
+            try:
+                file_obj = open(txt_filename, 'rt')
+                txt = file_obj.read()
                 file_obj.close()
-            print(termcolor.colored('Error replace in text file <%s>' % txt_filename, 'red'))
-            raise
-    else:
-        print(termcolor.colored('Text file <%s> not exists' % txt_filename, 'yellow'))
+                txt = txt.replace(src_text, dst_text)
+                if auto_add and (dst_text not in txt):
+                    txt += cr
+                    txt += dst_text
+                    print(termcolor.colored('Text file append <%s> in <%s>' % (dst_text, txt_filename), 'green'))
+                file_obj = None
+                file_obj = open(txt_filename, 'wt')
+                file_obj.write(txt)
+                file_obj.close()
+                file_obj = None
+                return True
+            except:
+                if file_obj:
+                    file_obj.close()
+                print(termcolor.colored('Error replace in text file <%s>' % txt_filename, 'red'))
+                raise
+        else:
+            print(termcolor.colored('Text file <%s> not exists' % txt_filename, 'yellow'))
     return False
 
 
@@ -159,25 +583,66 @@ def isInTextFile(txt_filename, find_text):
     """
     txt_filename = os.path.normpath(txt_filename)
 
-    if os.path.exists(txt_filename):
-        file_obj = None
-        try:
-            file_obj = open(txt_filename, 'rt')
-            txt = file_obj.read()
-            result = find_text in txt
-            file_obj.close()
+    with lockTextFile(txt_filename):
+        if os.path.exists(txt_filename):
             file_obj = None
-            return result
-        except:
-            if file_obj:
+            try:
+                file_obj = open(txt_filename, 'rt')
+                txt = file_obj.read()
+                result = find_text in txt
                 file_obj.close()
-            print(termcolor.colored('Error find <%s> in text file <%s>' % (find_text, txt_filename), 'red'))
-            raise
-    else:
-        print(termcolor.colored('Text file <%s> not exists' % txt_filename, 'yellow'))
+                file_obj = None
+                return result
+            except:
+                if file_obj:
+                    file_obj.close()
+                print(termcolor.colored('Error find <%s> in text file <%s>' % (find_text, txt_filename), 'red'))
+                raise
+        else:
+            print(termcolor.colored('Text file <%s> not exists' % txt_filename, 'yellow'))
     return False
 
 
+def appendTextFileIfNotExists(txt_filename, txt, cr=None, timeout=None):
+    """
+    Add text to text file if it is not there yet.
+    The check and the addition are performed under one file lock,
+    so concurrent runs do not duplicate the text.
+
+    :param txt_filename: Text filename.
+    :param txt: Added text.
+    :param cr: Carriage return character.
+    :param timeout: Lock wait timeout in seconds.
+    :return: True - text added, False - text already exists.
+    """
+    with lockTextFile(txt_filename, timeout=timeout):
+        if os.path.exists(txt_filename) and isInTextFile(txt_filename, txt):
+            return False
+        return appendTextFile(txt_filename, txt, cr=cr)
+
+
+def replaceTextFileIfNotExists(txt_filename, find_text, src_text, dst_text,
+                               auto_add=True, cr=None, timeout=None):
+    """
+    Replacing a text in a text file if find text is not there yet.
+    The check and the replacement are performed under one file lock,
+    so concurrent runs do not duplicate the text.
+
+    :param txt_filename: Text filename.
+    :param find_text: Find text.
+    :param src_text: Source text.
+    :param dst_text: Destination text.
+    :param auto_add: A flag to automatically add a new line.
+    :param cr: Carriage return character.
+    :param timeout: Lock wait timeout in seconds.
+    :return: True - text replaced, False - find text already exists or error.
+    """
+    with lockTextFile(txt_filename, timeout=timeout):
+        if isInTextFile(txt_filename, find_text):
+            return False
+        return replaceTextFile(txt_filename, src_text, dst_text, auto_add=auto_add, cr=cr)
+
+
 def generateTextFile(txt_template_filename, txt_output_filename, context=None, output_encoding=None):
     """
     Generation of a text file from a template file.
@@ -238,10 +703,11 @@ def generateTextFile(txt_template_filename, txt_output_filename, context=None, o
             print(termcolor.colored(u'Create directory <%s>' % output_path, 'green'))
             os.makedirs(output_path)
 
-        output_file = open(output_filename, 'w+')
-        output_file.write(gen_txt)
-        output_file.close()
-        return os.path.exists(output_filename)
+        with lockTextFile(output_filename):
+            output_file = open(output_filename, 'w+')
+            output_file.write(gen_txt)
+            output_file.close()
+            return os.path.exists(output_filename)
     except:
         if output_file:
             output_file.close()
@@ -1 +1,4 @@
 # !/bin/sh
+
+# Lock files of configuration script
+rm --force ~/.config/mc/*.lock ~/.config/mc/*.lck